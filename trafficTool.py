@@ -2,10 +2,31 @@ from datetime import datetime, timedelta, timezone
 from mpl_toolkits.basemap import Basemap
 import matplotlib.animation as animation
 import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 import numpy as np
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
-import json
+import aiohttp
+import asyncio
+import random
+import threading
+import simdjson
+import orjson
+
+_loads = orjson.loads
+_sjlocal = threading.local()
+
+
+def _sjparser():
+    """
+    Returns the simdjson parser of the calling thread - parsers are reused
+    between documents, but may not be shared across threads.
+    """
+    if not hasattr(_sjlocal, "parser"):
+        _sjlocal.parser = simdjson.Parser()
+    return _sjlocal.parser
 
 
 class TrafficTool:
@@ -14,8 +35,25 @@ class TrafficTool:
     https://www.vegvesen.no/trafikkdata/start/om-api
     """
 
+    url = "https://www.vegvesen.no/trafikkdata/api/"
+    headers = {"content-type": "application/json"}
+    max_retries = 3
+    retry_status_codes = {429, 500, 502, 503, 504}
+
     def __init__(self):
-        pass
+        self._session = requests.Session()
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=1.0,
+            status_forcelist=sorted(self.retry_status_codes),
+            allowed_methods=["POST"],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self._session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry),
+        )
 
     @staticmethod
     def string_to_datetime(string: str):
@@ -23,7 +61,7 @@ class TrafficTool:
         Converts a string in the format "%Y-%m-%dT%H:%M:%S+02:00" to a datetime
         object.
         """
-        return datetime.strptime(string[:-6], "%Y-%m-%dT%H:%M:%S")
+        return datetime.fromisoformat(string[:-6])
 
     @staticmethod
     def datetime_to_string(datetime_object: datetime):
@@ -33,26 +71,34 @@ class TrafficTool:
         """
         return datetime_object.strftime("%Y-%m-%dT%H:%M:%S+02:00")
 
-    def request(self, query: str):
-        """
-        Makes a request to the Vegvesen API using a given query
+    @staticmethod
+    def backoff_delay(attempt: int, retry_after: str = None):
         """
-        url = "https://www.vegvesen.no/trafikkdata/api/"
-        headers = {"content-type": "application/json"}
-        data = query
-
-        attempts = 10
+        Returns the number of seconds to wait after a failed attempt (counting
+        from 0) before retrying an asynchronous request: exponential backoff
+        with up to 50% random jitter, capped at 30 seconds.  A numeric
+        Retry-After header value sent by the API takes precedence.
 
-        while attempts > 0:
+        Synchronous requests are retried by the HTTPAdapter of the session.
+        """
+        base = 1.0
+        jitter = 0.5
+        cap = 30.0
+        if retry_after is not None:
             try:
-                response = requests.post(url, headers=headers, data=data, timeout=2)
-                break
-            except requests.exceptions.ReadTimeout:
-                attempts -= 1
+                return min(float(retry_after), cap)
+            except ValueError:
+                pass
+        delay = base * 2**attempt * (1 + random.random() * jitter)
+        return min(delay, cap)
 
-        if attempts <= 0:
-            msg = f"Error connecting to Vegvesen API - " f"Time Out"
-            raise requests.exceptions.ReadTimeout(msg)
+    def request(self, query: str):
+        """
+        Makes a request to the Vegvesen API using a given query
+        """
+        response = self._session.post(
+            self.url, headers=self.headers, data=query, timeout=2
+        )
 
         if response.status_code != 200:
             msg = (
@@ -62,6 +108,45 @@ class TrafficTool:
             raise ConnectionError(msg)
         return response
 
+    async def _fetch(
+        self,
+        session: aiohttp.ClientSession,
+        sem: asyncio.Semaphore,
+        query: bytes,
+    ):
+        """
+        Asynchronous counterpart to method request - makes a request to the
+        Vegvesen API using a given query and returns the raw response body.
+        At most as many requests as allowed by sem are in flight at once.
+        """
+        timeout = aiohttp.ClientTimeout(sock_connect=2, sock_read=2)
+
+        async with sem:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                try:
+                    async with session.post(
+                        self.url, headers=self.headers, data=query, timeout=timeout
+                    ) as response:
+                        status = response.status
+                        retry_after = response.headers.get("Retry-After")
+                        content = await response.read()
+                except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                    if attempt >= self.max_retries:
+                        msg = f"Error connecting to Vegvesen API - " f"Time Out"
+                        raise ConnectionError(msg) from e
+                else:
+                    if status not in self.retry_status_codes:
+                        break
+                    if attempt >= self.max_retries:
+                        break
+                await asyncio.sleep(self.backoff_delay(attempt, retry_after))
+
+        if status != 200:
+            msg = f"Error connecting to Vegvesen API - " f"Status Code {status}"
+            raise ConnectionError(msg)
+        return content
+
     def query_traffic_registration_point_search(
         self,
         roadCategoryIds: List[str] = None,
@@ -134,6 +219,57 @@ class TrafficTool:
         query = query.format(searchQuery)
         return query
 
+    def _parse_volume_by_hour(self, content: bytes, n_points: int):
+        """
+        Extracts the hourly traffic volumes from the raw body of a response to
+        a query built by method aquery_traffic_volume_by_hour, in which the
+        data for n_points traffic registration points is aliased t0, t1, ...
+        Returns a list with the volumes of each point, which is None for
+        points without volume data.
+
+        Only the required fields are read from the lazily parsed document;
+        these are all scalars, which simdjson returns as plain Python objects,
+        so no reference to the (reused) parser outlives this call.
+        """
+        temp_lists = []
+        doc = _sjparser().parse(content)
+        data = doc["data"]
+        if data is None:
+            # Failed query, e.g. a GraphQL error response
+            return [None] * n_points
+        for k in range(n_points):
+            edges = data[f"t{k}"]
+            for key in ("volume", "byHour", "edges"):
+                if edges is None:
+                    break
+                edges = edges[key]
+            if edges is None:
+                # No volume data for this TRP
+                temp_lists.append(None)
+                continue
+
+            temp_list = []
+            for j in edges:
+                node = j["node"] if j is not None else None
+                total = node["total"] if node is not None else None
+                if (
+                    total is None
+                    or total["volumeNumbers"] is None
+                    or total["coverage"] is None
+                ):
+                    # Incomplete volume data for this TRP
+                    temp_list = None
+                    break
+                element = {
+                    "start": self.string_to_datetime(node["from"]),
+                    "stop": self.string_to_datetime(node["to"]),
+                    "volume": total["volumeNumbers"]["volume"],
+                    "coverage": total["coverage"]["percentage"],
+                }
+                temp_list.append(element)
+            temp_lists.append(temp_list)
+        return temp_lists
+
     def query_traffic_volume_by_hour(
         self,
         trafficRegistrationPoints: List[str],
@@ -143,69 +279,100 @@ class TrafficTool:
         """
         Returns a list of hourly traffic volumes between two points in time
         """
+        return asyncio.run(
+            self.aquery_traffic_volume_by_hour(trafficRegistrationPoints, start, stop)
+        )
+
+    async def aquery_traffic_volume_by_hour(
+        self,
+        trafficRegistrationPoints: List[str],
+        start: datetime,
+        stop: datetime,
+    ):
+        """
+        Asynchronous variant of method query_traffic_volume_by_hour - all
+        requests are sent concurrently over a single pool of connections.
+        """
 
-        query_template = (
-            '{{{{"query": "{{{{trafficData(trafficRegistrationPointId: \\"{}\\")'
-            ' {{{{ volume {{{{ byHour(from: \\"{}\\", to: \\"{}\\") {{{{ edges '
-            "{{{{ node {{{{from to total {{{{ volumeNumbers {{{{ volume }}}} "
-            'coverage {{{{ percentage }}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}}", '
-            '"variables": null}}}}'
+        # {ALIAS}, {ID}, {START} and {STOP} are substituted with str.replace,
+        # so that the GraphQL braces need no escaping
+        selection_template = (
+            '{ALIAS}: trafficData(trafficRegistrationPointId: \\"{ID}\\")'
+            ' { volume { byHour(from: \\"{START}\\", to: \\"{STOP}\\") { edges '
+            "{ node {from to total { volumeNumbers { volume } "
+            "coverage { percentage }}}}}}}"
         )
 
-        divisions = []
-        t = start
-        start_step = start
-        t_count = timedelta()
-        dt = timedelta(hours=1)
+        # Up to batch_size traffic registration points are requested per query,
+        # each under its own alias
+        batch_size = 20
+        batches = [
+            trafficRegistrationPoints[k : k + batch_size]
+            for k in range(0, len(trafficRegistrationPoints), batch_size)
+        ]
+
+        # The API returns at most 99 hours of data per query
         query_hour_limit = timedelta(hours=99)
-        while t < stop:
-            if t_count >= query_hour_limit:
-                t_count = timedelta()
-                divisions.append((start_step, t))
-                start_step = t
-            t_count += dt
-            t += dt
-        if start_step != t:
-            divisions.append((start_step, t))
+        n_divisions = -(-(stop - start) // query_hour_limit)
+        divisions = [
+            (
+                start + k * query_hour_limit,
+                min(start + (k + 1) * query_hour_limit, stop),
+            )
+            for k in range(n_divisions)
+        ]
 
-        itermax = len(trafficRegistrationPoints) * len(divisions)
+        queries = []
+        for start_step, stop_step in divisions:
+            selection_template_dated = selection_template.replace(
+                "{START}", self.datetime_to_string(start_step)
+            ).replace("{STOP}", self.datetime_to_string(stop_step))
+
+            for batch in batches:
+                selections = " ".join(
+                    selection_template_dated.replace("{ALIAS}", f"t{k}").replace(
+                        "{ID}", i
+                    )
+                    for k, i in enumerate(batch)
+                )
+                query = '{"query": "{' + selections + '}", "variables": null}'
+                queries.append((batch, query.encode()))
+
+        itermax = len(queries)
+        count = 0
         perc = -1
         trafficVolumeByHour = {}
 
         print()
 
-        for m, (start_step, stop_step) in enumerate(divisions):
-            start_str = self.datetime_to_string(start_step)
-            stop_str = self.datetime_to_string(stop_step)
-            query_template_dated = query_template.format("{}", start_str, stop_str)
-
-            for n, i in enumerate(trafficRegistrationPoints):
-                query = query_template_dated.format(i)
-                response = self.request(query)
-                new_perc = round(100 * (n * m + n) / itermax, 1)
-                if new_perc > perc:
-                    perc = new_perc
-                    print(f"\rDOWNLOADING - {perc}%", end="")
-                temp_list = []
-                try:
-                    for j in response.json()["data"]["trafficData"]["volume"]["byHour"][
-                        "edges"
-                    ]:
-                        element = {
-                            "start": self.string_to_datetime(j["node"]["from"]),
-                            "stop": self.string_to_datetime(j["node"]["to"]),
-                            "volume": j["node"]["total"]["volumeNumbers"]["volume"],
-                            "coverage": j["node"]["total"]["coverage"]["percentage"],
-                        }
-                        temp_list.append(element)
-                except TypeError:
-                    pass
-                    # print(f"No volume data for TRP {i}")
-                else:
-                    if i in trafficVolumeByHour.keys():
-                        trafficVolumeByHour[i].extend(temp_list)
-                    else:
-                        trafficVolumeByHour[i] = temp_list
+        async def fetch(session, sem, batch, query):
+            nonlocal count, perc
+            content = await self._fetch(session, sem, query)
+            count += 1
+            new_perc = round(100 * count / itermax, 1)
+            if new_perc > perc:
+                perc = new_perc
+                print(f"\rDOWNLOADING - {perc}%", end="")
+            # Each response is parsed as soon as it arrives, while the other
+            # requests are still in flight, and its raw body is then dropped;
+            # parsing runs in a worker thread to keep the event loop free
+            return await loop.run_in_executor(
+                pool, self._parse_volume_by_hour, content, len(batch)
+            )
+
+        loop = asyncio.get_running_loop()
+        sem = asyncio.Semaphore(32)
+        connector = aiohttp.TCPConnector(limit=64, ttl_dns_cache=300)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                responses = await asyncio.gather(
+                    *(fetch(session, sem, batch, query) for batch, query in queries)
+                )
+
+        for (batch, _), temp_lists in zip(queries, responses):
+            for i, temp_list in zip(batch, temp_lists):
+                if temp_list is not None:
+                    trafficVolumeByHour.setdefault(i, []).extend(temp_list)
 
         print(f"\rDOWNLOADING - 100.0%")
 
@@ -232,7 +399,9 @@ class TrafficTool:
             registrationFrequency,
         )
         response = self.request(query)
-        trafficRegistrationPoints = response.json()["data"]["trafficRegistrationPoints"]
+        trafficRegistrationPoints = _loads(response.content)["data"][
+            "trafficRegistrationPoints"
+        ]
         trafficRegistrationPoints = [
             {
                 "id": i["id"],
@@ -254,8 +423,10 @@ class TrafficTool:
         start = start.replace(microsecond=0, second=0, minute=0)
         stop = stop.replace(microsecond=0, second=0, minute=0)
 
-        trafficVolumeByHour = self.query_traffic_volume_by_hour(
-            [i["id"] for i in trafficRegistrationPoints], start, stop
+        trafficVolumeByHour = asyncio.run(
+            self.aquery_traffic_volume_by_hour(
+                [i["id"] for i in trafficRegistrationPoints], start, stop
+            )
         )
 
         sortedTrafficVolumeByHour = {}
@@ -265,18 +436,21 @@ class TrafficTool:
             sortedTrafficVolumeByHour[t] = {}
             t += dt
 
-        max_volume = 0
-
         for i in trafficRegistrationPoints:
             id = i["id"]
-            if id in trafficVolumeByHour.keys():
+            if id in trafficVolumeByHour:
                 for j in trafficVolumeByHour[id]:
                     sortedTrafficVolumeByHour[j["start"]][id] = {
                         "volume": j["volume"],
                         "lat": i["lat"],
                         "lon": i["lon"],
                     }
-                    max_volume = max(max_volume, j["volume"])
+
+        volumes = np.fromiter(
+            (j["volume"] for i in trafficVolumeByHour.values() for j in i),
+            dtype=np.int32,
+        )
+        max_volume = int(volumes.max()) if volumes.size else 0
 
         return sortedTrafficVolumeByHour, max_volume
 
@@ -311,6 +485,20 @@ class TrafficTool:
 
         return m
 
+    @staticmethod
+    def freeze_map(fig: plt.Figure, ax: plt.Axes):
+        """
+        Renders the map drawn by method plot_map once and replaces it with a
+        single image, so that coastlines, parallels, etc. are not redrawn for
+        each frame when saving an animation.  Artists added afterwards are
+        drawn on top as usual.  The figure must be saved at fig.dpi.
+        """
+        fig.canvas.draw()
+        background = np.asarray(fig.canvas.buffer_rgba()).copy()
+        for artist in ax.get_children():
+            artist.set_visible(False)
+        fig.figimage(background, zorder=-1, origin="upper")
+
     def plot_map_points(
         self,
         lat: List[float],
@@ -326,20 +514,38 @@ class TrafficTool:
         given, markers/colors/sizes must be of equal length to x and y.
         """
         m = self.plot_map(water_color, land_color)
-        for i in range(len(lat)):
-            x_i = lon[i]
-            y_i = lat[i]
-            marker = "."
-            color = "r"
-            size = "5"
-            if markers is not None:
-                marker = markers[i]
-            if colors is not None:
-                color = colors[i]
-            if sizes is not None:
-                size = sizes[i]
-            x_i, y_i = m(x_i, y_i)
-            m.plot(x_i, y_i, 3, marker=marker, color=color, ms=size)
+        x, y = m(np.asarray(lon), np.asarray(lat))
+        if markers is None:
+            markers = ["."] * len(lat)
+        if colors is None:
+            colors = ["r"] * len(lat)
+        if sizes is None:
+            sizes = [5] * len(lat)
+        sizes = np.asarray(sizes, dtype=float)
+
+        # One scatter per marker style, since scatter takes a single marker;
+        # markers may be any Matplotlib marker spec, e.g. tuples, so they are
+        # grouped by value rather than converted to an array.  Unhashable
+        # specs, such as lists of vertices, are each plotted on their own.
+        groups = {}
+        for n, marker in enumerate(markers):
+            try:
+                key = (marker,)
+                hash(key)
+            except TypeError:
+                key = n
+            groups.setdefault(key, (marker, []))[1].append(n)
+
+        # Sizes are squared since scatter takes areas in points^2
+        for marker, k in groups.values():
+            m.scatter(
+                x[k],
+                y[k],
+                s=sizes[k] ** 2,
+                c=[colors[n] for n in k],
+                marker=marker,
+                zorder=3,
+            )
 
     def plot_traffic_registration_points(
         self,
@@ -397,104 +603,91 @@ class TrafficTool:
         plt.xlabel(f"Date & Time {datetime_object}", labelpad=30, fontweight="bold")
         return m
 
+    @staticmethod
+    def traffic_volume_to_arrays(sortedTrafficVolumeByHour: Dict):
+        """
+        Converts the dictionary returned by method get_traffic_volume_by_hour
+        to arrays.  Returns the sorted datetimes, the latitudes and longitudes
+        of each traffic registration point with data, and a float32 array of
+        shape (datetimes, points) containing the traffic volumes, in which
+        missing data is NaN.
+        """
+        datetimes = sorted(sortedTrafficVolumeByHour.keys())
+
+        coordinates = {}
+        for hour in sortedTrafficVolumeByHour.values():
+            for id, i in hour.items():
+                if id not in coordinates:
+                    coordinates[id] = (i["lat"], i["lon"])
+        index = {id: n for n, id in enumerate(coordinates)}
+
+        lat = np.array([i[0] for i in coordinates.values()], dtype=np.float32)
+        lon = np.array([i[1] for i in coordinates.values()], dtype=np.float32)
+        vol = np.full((len(datetimes), len(index)), np.nan, dtype=np.float32)
+        for t, datetime_object in enumerate(datetimes):
+            for id, i in sortedTrafficVolumeByHour[datetime_object].items():
+                vol[t, index[id]] = i["volume"]
+
+        return datetimes, lat, lon, vol
+
     def animate_traffic_volume(
         self,
         sortedTrafficVolumeByHour: Dict,
-        max_volume: int,
+        max_volume: int = None,
         water_color: str = "lightblue",
         land_color: str = "lightgreen",
         save_as: str = None,
     ):
+        """
+        Animates the hourly traffic volume returned by method
+        get_traffic_volume_by_hour on a map of Norway.  If max_volume is not
+        given, the largest volume in sortedTrafficVolumeByHour is used.
+        """
         m = self.plot_map(water_color, land_color)
+        if save_as is not None:
+            self.freeze_map(plt.gcf(), plt.gca())
 
-        points = []
-
-        lat = []
-        lon = []
-        markers = []
-        colors = []
-        sizes = []
         max_size = 40
         min_size = 3
-        datetimes = sorted(sortedTrafficVolumeByHour.keys())
-
-        for i in sortedTrafficVolumeByHour[datetimes[0]].values():
-            lat.append(i["lat"])
-            lon.append(i["lon"])
-            markers.append(".")
-            colors.append("r")
-            scale = (max_size * float(i["volume"]) / max_volume) + min_size
-            sizes.append(scale)
-
-        for n in range(len(lon)):
-            x_n, y_n = m(lon[n], lat[n])
-            point = m.plot(
-                x_n, y_n, 3, marker=markers[n], color=colors[n], ms=sizes[n]
-            )[0]
-            points.append(point)
+        datetimes, lat, lon, vol = self.traffic_volume_to_arrays(
+            sortedTrafficVolumeByHour
+        )
+        x, y = m(lon, lat)
+        if max_volume is None:
+            # 0 if there is no volume data at all
+            has_data = ~np.isnan(vol)
+            max_volume = np.max(vol, where=has_data, initial=0)
+
+        # Marker areas (in points^2, as taken by scatter) for every frame, kept
+        # in single precision since a row is read for each frame; points
+        # without data for a given hour are hidden
+        scale = np.float32(max_size / max_volume if max_volume else 0)
+        sizes_matrix = np.where(
+            np.isnan(vol), np.float32(0), (vol * scale + np.float32(min_size)) ** 2
+        )
 
-        xlabel = plt.xlabel(
-            f"Date & Time {datetimes[0]}", labelpad=30, fontweight="bold"
+        points = m.scatter(x, y, s=sizes_matrix[0], c="r", marker=".", zorder=3)
+
+        # The date is drawn inside the axes so that it is redrawn when blitting
+        date_label = plt.gca().text(
+            0.02,
+            0.98,
+            f"Date & Time {datetimes[0]}",
+            transform=plt.gca().transAxes,
+            va="top",
+            fontweight="bold",
+            bbox={"facecolor": "k"},
         )
 
         def init():
-
-            lat = []
-            lon = []
-            markers = []
-            colors = []
-            sizes = []
-
-            for i in sortedTrafficVolumeByHour[datetimes[0]].values():
-                lat.append(i["lat"])
-                lon.append(i["lon"])
-                markers.append(".")
-                colors.append("r")
-                scale = (max_size * float(i["volume"]) / max_volume) + min_size
-                sizes.append(scale)
-
-            for n, point in enumerate(points):
-                x_n, y_n = m(lon[n], lat[n])
-                point.set_data(x_n, y_n)
-                point.set_marker(markers[n])
-                point.set_color(colors[n])
-
-            plt.gca().set_xlabel(
-                f"Date & Time {datetimes[0]}", labelpad=30, fontweight="bold"
-            )
-
-            return points
+            points.set_sizes(sizes_matrix[0])
+            date_label.set_text(f"Date & Time {datetimes[0]}")
+            return points, date_label
 
         def animate(i):
-
-            lat = []
-            lon = []
-            markers = []
-            colors = []
-            sizes = []
-
-            for j in sortedTrafficVolumeByHour[datetimes[i]].values():
-                lat.append(j["lat"])
-                lon.append(j["lon"])
-                markers.append(".")
-                colors.append("r")
-                scale = (max_size * float(j["volume"]) / max_volume) + min_size
-                sizes.append(scale)
-
-            for n, point in enumerate(points):
-                try:
-                    x_n, y_n = m(lon[n], lat[n])
-                    point.set_data(x_n, y_n)
-                    point.set_marker(markers[n])
-                    point.set_color(colors[n])
-                    point.set_markersize(sizes[n])
-                except:
-                    point.set_markersize(0)
-
-            plt.gca().set_xlabel(
-                f"Date & Time {datetimes[i]}", labelpad=30, fontweight="bold"
-            )
-            return points
+            points.set_sizes(sizes_matrix[i])
+            date_label.set_text(f"Date & Time {datetimes[i]}")
+            return points, date_label
 
         anim = animation.FuncAnimation(
             plt.gcf(),
@@ -502,7 +695,7 @@ class TrafficTool:
             init_func=init,
             frames=len(datetimes),
             interval=200,
-            blit=False,
+            blit=True,
         )
 
         if save_as is None:
@@ -511,7 +704,8 @@ class TrafficTool:
             plt.close()
         else:
             print("SAVING ANIMATION")
-            anim.save(f"{save_as}.mp4", writer="ffmpeg", fps=16, dpi=200)
+            # Saved at the figure dpi, which the frozen map was rendered at
+            anim.save(f"{save_as}.mp4", writer="ffmpeg", fps=16, dpi=plt.gcf().dpi)
             plt.close()
 
     def traffic_animation(